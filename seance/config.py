@@ -4,7 +4,7 @@ import os
 import builtins
 import argparse
 import configparser
-from typing import Optional, Any
+from typing import Optional, Any, Sequence
 from dataclasses import dataclass, field, asdict
 
 @dataclass
@@ -77,7 +77,7 @@ class ConfigHandler:
         self.option_values_by_argparse_name[option._argparse_name] = value
 
 
-    def __init__(self, options: list[ConfigOption], *, env_var_prefix='', config_section,
+    def __init__(self, options: Sequence[ConfigOption], *, env_var_prefix='', config_section,
             argparse_init_kwargs=None, argparser_class=argparse.ArgumentParser,
             configparser_init_kwargs=None, configparser_class=configparser.ConfigParser,
         ):
@@ -4,10 +4,17 @@ import os
 import re
 import sys
 import json
+import time
 import asyncio
+import queue
+import logging
 import argparse
+import functools
+import importlib.util
+import logging.handlers
 from io import StringIO
 from typing import Union, Optional
+from dataclasses import dataclass, field
 
 import discord
 from discord import Message, Member, Status, ChannelType
@@ -25,24 +32,111 @@ from PythonSed import Sed
 
 from emoji import is_emoji
 
-try:
-    import sdnotify
-except ImportError:
-    pass
-
 
 from ..config import ConfigOption, ConfigHandler
+from ..patterns import prefiltered_matcher, re2_equivalent
 from .dm_mode import DiscordDMGuildManager
 
 
 # A pattern that matches a link to a Discord message, and captures the channel ID and message ID.
 DISCORD_MESSAGE_URL_PATTERN = re.compile(r'https://(?:\w+.)?discord(?:app)?.com/channels/\d+/(\d+)/(\d+)')
 
-# A pattern for matching Discord activities (https://discord.com/developers/docs/topics/gateway#activity-object).
-DISCORD_STATUS_PATTERN = re.compile(r'(?P<type>playing|streaming|listening to|watching|competing in)?\s*(?P<name>.+)', re.IGNORECASE | re.DOTALL)
+# The words that can start a Discord activity (https://discord.com/developers/docs/topics/gateway#activity-object),
+# and the activity type each one means.
+DISCORD_ACTIVITY_PREFIXES = (
+    ('playing', ActivityType.playing),
+    ('streaming', ActivityType.streaming),
+    ('listening to', ActivityType.listening),
+    ('watching', ActivityType.watching),
+    ('competing in', ActivityType.competing),
+)
+
+# The longest emoji (ZWJ sequences with skin tones, like 👩🏻‍❤️‍💋‍👨🏼) are around 10 code points, so anything longer than this
+# can't be one.
+MAX_EMOJI_LEN = 16
+
+# No reaction shortcut is longer than this: custom emoji names are at most 32 characters and IDs at most 20 digits.
+MAX_SHORTCUT_LEN = 64
+
+# How long a fetched Member for the reference user is reused for, in seconds.
+REF_MEMBER_CACHE_SECONDS = 30
+
+# How long to wait for other history requests in the same channel to join a pending one, in seconds.
+HISTORY_COALESCE_SECONDS = 0.05
+
+# How long to wait for the reference user's status to settle before adopting it, in seconds.
+PRESENCE_SYNC_DELAY_SECONDS = 1
+
+
+# The hosts that links to Discord messages actually use.
+DISCORD_MESSAGE_URL_HOSTS = (
+    'https://discord.com',
+    'https://canary.discord.com',
+    'https://ptb.discord.com',
+    'https://discordapp.com',
+)
+
+
+def _parse_message_url(url: str) -> Optional[tuple[int, int]]:
+    """ Returns the channel ID and message ID from a link to a Discord message, or None if `url` isn't one.
+
+    These links have a rigid structure (`https://discord.com/channels/<guild>/<channel>/<message>`), so the usual
+    case is handled by splitting, and DISCORD_MESSAGE_URL_PATTERN is only used for anything out of the ordinary.
+    """
+
+    if 'discord' not in url or '/channels/' not in url:
+        return None
+
+    host, _sep, path = url.partition('/channels/')
+    ids = path.split('/')
+    if host in DISCORD_MESSAGE_URL_HOSTS and len(ids) == 3 and all(id_.isdecimal() for id_ in ids):
+        return int(ids[1]), int(ids[2])
+
+    matches = DISCORD_MESSAGE_URL_PATTERN.match(url)
+    if matches is None:
+        return None
+
+    return int(matches.group(1)), int(matches.group(2))
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_activity_spec_cached(spec: str) -> Optional[tuple[ActivityType, str]]:
+    """ Does the actual parsing for `SeanceClient._parse_activity_spec()`.
+
+    Returns the activity type and name rather than an `Activity`, so the result can be safely cached and shared.
+    The cache is bounded, as `spec` comes straight from user input.
+    """
+
+    # The set of activity types is small and fixed, so just check for each of them (case-insensitively).
+    for prefix, activity_type in DISCORD_ACTIVITY_PREFIXES:
+        if spec[:len(prefix)].casefold() == prefix:
+            name = spec[len(prefix):].lstrip()
+            if name:
+                return activity_type, name
+
+            # Otherwise the activity type word is all there is, so treat it as the name instead.
+            break
+
+    # If not specified, default to "Playing".
+    name = spec.lstrip()
+    if name:
+        return ActivityType.playing, name
+
+    return None
+
 
-# A pattern for matching the reaction add (and remove) shortcuts in the standard client.
-DISCORD_REACTION_SHORTCUT_PATTERN = re.compile(r'(?P<action>[+-])\<a?:\w{2,}:(?P<id>\d+)\>')
+@dataclass
+class _HistoryBatch:
+    """ A pending channel history fetch, shared by every request for that channel's history that comes in
+    before it starts. Used by SeanceClient._get_recent().
+    """
+
+    future: asyncio.Future
+    limit: int = 0
+    requests: int = 0
+    # The ID of the newest message that made a request; anything after it isn't fetched.
+    newest_id: int = 0
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
 
 
 class KeepCurrentSentinel:
@@ -54,28 +148,101 @@ def running_in_systemd() -> bool:
     return 'INVOCATION_ID' in os.environ
 
 
+def _setup_logging() -> logging.handlers.QueueListener:
+    """ Routes all log records (both Séance's and discord.py's) through a queue to a stderr handler on a background
+    thread, so that logging from event handlers never blocks the event loop on I/O. The returned listener is already
+    started, and should be stopped on exit to flush anything still queued.
+    """
+
+    log_queue = queue.SimpleQueue()
+
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stderr_handler)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+
+    listener.start()
+    return listener
+
+
+@functools.lru_cache(maxsize=512)
+def _cached_is_emoji(s: str) -> bool:
+    # The set of emoji someone actually reacts with is small, so this mostly hits the cache.
+    return is_emoji(s)
+
+
+def _matches_simple_react(content: str) -> bool:
+    # Check the cheap things first, so `is_emoji()` only ever sees plausible candidates.
+    return 1 < len(content) <= MAX_EMOJI_LEN + 1 and content[0] in "+-" and _cached_is_emoji(content[1:])
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_custom_react(content: str) -> Optional[tuple[str, int]]:
+    """ Parses a custom reaction shortcut (like `+<:name:1234>`) into its action (`+` or `-`) and emoji ID,
+    or returns None if `content` isn't one.
+
+    This is the reaction add (and remove) shortcut from the standard client, `[+-]<a?:name:id>`, where the name is
+    at least two word characters. The format is rigid enough that it's parsed by hand rather than with a regex.
+    """
+
+    # The shortest possible shortcut is `+<:ab:1>`.
+    if len(content) < 8 or content[0] not in '+-' or content[1] != '<' or content[-1] != '>':
+        return None
+
+    # Animated emoji have an extra `a` before the name.
+    emoji = content[2:-1]
+    if emoji.startswith('a:'):
+        emoji = emoji[1:]
+
+    if not emoji.startswith(':'):
+        return None
+
+    name, sep, emoji_id = emoji[1:].partition(':')
+    if not sep or len(name) < 2 or not emoji_id.isdecimal():
+        return None
+
+    if not all(char.isalnum() or char == '_' for char in name):
+        return None
+
+    return content[0], int(emoji_id)
+
+
+def _matches_custom_react(content: str) -> bool:
+    return _parse_custom_react(content) is not None
+
+
 class SeanceClient(discord.Client):
 
     def __init__(self, ref_user_id, pattern, command_prefix, *args, dm_guild_id=None, dm_manager_options=None,
-        sdnotify=False, default_status=False, default_presence=False, forward_pings=None, **kwargs
+        sdnotify=False, default_status=False, default_presence=False, forward_pings=None, debug_events=False, **kwargs
     ):
 
         self.ref_user_id = ref_user_id
 
-        # If we weren't given an already compiled re.Pattern, compile it now.
-        if not isinstance(pattern, re.Pattern):
+        # If we weren't given an already compiled pattern (from `re` or `re2`), compile it now.
+        if isinstance(pattern, str):
             self.pattern = re.compile(pattern, re.DOTALL)
         else:
             self.pattern = pattern
 
+        self._match = prefiltered_matcher(self.pattern)
+        # The number of the `content` group, so matches don't have to look it up by name.
+        self._content_group = self.pattern.groupindex['content']
+
         self.command_prefix = command_prefix
+        # The prefix as it appears at the start of a prefixed command, like `b!`.
+        self._prefix_bang = command_prefix + '!'
         self.dm_guild_id = dm_guild_id
         self.sdnotify = sdnotify
         self.default_status = default_status
         self.default_presence = default_presence
         self.forward_pings = forward_pings
 
-        super().__init__(*args, enable_debug_events=True, **kwargs)
+        # Debug events are dispatched for every gateway frame, and nothing here listens for them, so they're opt-in.
+        super().__init__(*args, enable_debug_events=debug_events, **kwargs)
 
         # self.ref_user() will populate this when it's accessed.
         self._ref_user = None
@@ -88,6 +255,16 @@ class SeanceClient(discord.Client):
         self._current_activity = None
         self._current_status = Status.online
 
+        # The last (time.monotonic() timestamp, Member) fetched for the reference user when syncing presence.
+        # Reused for REF_MEMBER_CACHE_SECONDS, and dropped when Discord tells us that member changed.
+        self._last_ref_member_fetch = None
+
+        # Pending _HistoryBatch for each channel ID; see _get_recent().
+        self._history_batches = {}
+
+        # A pending _sync_presence_soon() task, if any.
+        self._presence_sync_task = None
+
         self.command_handlers = {
             '!s/': self.handle_substitute_command,
             '!edit': self.handle_edit_command,
@@ -97,10 +274,21 @@ class SeanceClient(discord.Client):
             '!nick': self.handle_nickname_command,
         }
 
-        self.shortcut_handlers = {
-            self._matches_simple_react: self.handle_simple_reaction,
-            self._matches_custom_react: self.handle_custom_reaction,
-        }
+        # Commands are dispatched by looking up their first word, with or without the prefix.
+        # `!s/` is the exception, since its arguments follow it directly, so it's matched with startswith() instead.
+        self._command_table = {}
+        for command, handler in self.command_handlers.items():
+            self._command_table[command] = handler
+            self._command_table[command_prefix + command] = handler
+        self._substitute_commands = ('!s/', command_prefix + '!s/')
+        # Every way a command can start, to rule out messages that aren't commands with a single startswith().
+        self._command_tokens = tuple(self._command_table)
+
+        # Checked in order; this is a tuple of pairs rather than a dict since it's only ever iterated.
+        self.shortcut_handlers = (
+            (_matches_simple_react, self.handle_simple_reaction),
+            (_matches_custom_react, self.handle_custom_reaction),
+        )
 
 
         self.dm_guild_manager = None
@@ -108,38 +296,87 @@ class SeanceClient(discord.Client):
         self.slash = None
 
 
-    def _matches_command(self, content, command):
-        return content.startswith(command) or content.startswith(f"{self.command_prefix}{command}")
+    async def _set_presence(self, *, activity=keep_current, status=keep_current):
+        """ Allows setting activity and status separately without messing with each other. """
 
+        new_activity = self._current_activity if activity is keep_current else activity
+        new_status = self._current_status if status is keep_current else status
 
-    def _matches_simple_react(self, content):
+        await self.change_presence(activity=new_activity, status=new_status)
 
-        if len(content) > 1:
-            return content[0] in "+-" and is_emoji(content[1:])
-        else:
-            return False
+        if activity is not keep_current:
+            self._current_activity = activity
 
+        if status is not keep_current:
+            self._current_status = status
 
-    def _matches_custom_react(self, content):
-        if DISCORD_REACTION_SHORTCUT_PATTERN.fullmatch(content):
-            return True
-        else:
-            return False
 
+    async def _sync_presence_soon(self):
+        """ Adopts the reference user's cached status after PRESENCE_SYNC_DELAY_SECONDS.
 
-    async def _set_presence(self, *, activity=keep_current, status=keep_current):
-        """ Allows setting activity and status separately without messing with each other. """
+        Any status changes that come in while this is waiting just update the cache, so a burst of them results
+        in a single presence change.
+        """
 
-        new_activity = self._current_activity if activity == keep_current else activity
-        new_status = self._current_status if status == keep_current else status
+        await asyncio.sleep(PRESENCE_SYNC_DELAY_SECONDS)
+        self._presence_sync_task = None
 
-        await self.change_presence(activity=new_activity, status=new_status)
+        # An override may have been set while we were waiting, or the status may have changed back to what we
+        # already have, in which case there's nothing to send.
+        if self._status_override is not None or self._cached_status is self._current_status:
+            return
 
-        if activity != keep_current:
-            self._current_activity = activity
+        try:
+            await self._set_presence(status=self._cached_status)
+        except HTTPException as e:
+            print(f"Failed to apply presence: {e}.", file=sys.stderr)
 
-        if status != keep_current:
-            self._current_status = status
+
+    async def _get_recent(self, message: Message, limit: int) -> list[Message]:
+        """ Returns up to `limit` of the most recent messages in `message`'s channel, newest first, counting back from
+        (and including) `message` itself.
+
+        Requests for the same channel made within HISTORY_COALESCE_SECONDS of each other share a single history fetch,
+        so things like a `!s/` immediately followed by a reaction shortcut only cost one API call.
+        """
+
+        channel_id = message.channel.id
+
+        batch = self._history_batches.get(channel_id)
+        if batch is None:
+            batch = _HistoryBatch(asyncio.get_running_loop().create_future())
+            batch.task = asyncio.create_task(self._fetch_history_batch(message.channel, batch))
+            self._history_batches[channel_id] = batch
+
+        batch.limit = max(batch.limit, limit)
+        batch.requests += 1
+        batch.newest_id = max(batch.newest_id, message.id)
+
+        # Shielded so one requester being cancelled doesn't cancel the fetch for everyone else.
+        messages = await asyncio.shield(batch.future)
+
+        # The fetch may have happened after newer messages were sent, which this request shouldn't see.
+        return [msg for msg in messages if msg.id <= message.id][:limit]
+
+
+    async def _fetch_history_batch(self, channel, batch: _HistoryBatch):
+        """ Performs the history fetch for a _HistoryBatch, once other requests have had a chance to join it. """
+
+        await asyncio.sleep(HISTORY_COALESCE_SECONDS)
+
+        # Any requests after this point need a new fetch.
+        del self._history_batches[channel.id]
+
+        # Each request after the first may have been made by a newer message, which the earlier requests will skip
+        # over, so leave room for those. Messages sent after the newest request are excluded entirely, so they don't
+        # take up any of that room.
+        history = channel.history(limit=batch.limit + batch.requests - 1, before=discord.Object(id=batch.newest_id + 1))
+        try:
+            messages = [msg async for msg in history]
+        except Exception as e:
+            batch.future.set_exception(e)
+        else:
+            batch.future.set_result(messages)
 
 
     @staticmethod
@@ -159,6 +396,20 @@ class SeanceClient(discord.Client):
         return self._ref_user
 
 
+    async def _fetch_ref_member(self, guild: discord.Guild) -> Member:
+        """ Fetches the reference user's Member object in `guild`, reusing a recent fetch if there is one. """
+
+        if self._last_ref_member_fetch is not None:
+            timestamp, member = self._last_ref_member_fetch
+            if member.guild.id == guild.id and time.monotonic() - timestamp < REF_MEMBER_CACHE_SECONDS:
+                return member
+
+        member = await guild.fetch_member(self.ref_user_id)
+        self._last_ref_member_fetch = (time.monotonic(), member)
+
+        return member
+
+
     async def _get_shortcut_target(self, message: Message):
         """ Pulls out the referenced message, or the first non-invoking message."""
         # If the command replied to a message, then use that to get the message to edit.
@@ -169,9 +420,9 @@ class SeanceClient(discord.Client):
 
         # Otherwise, assume the most recent (non-invoking) message.
         else:
-            prev_messages = message.channel.history(limit=2)
+            prev_messages = await self._get_recent(message, 2)
             target = None
-            async for msg in prev_messages:
+            for msg in prev_messages:
                 if msg.id != message.id:
                     target = msg
                     break
@@ -209,38 +460,38 @@ class SeanceClient(discord.Client):
             end = message.content.find(' ', start)
             arg = message.content[start:end]
 
-            try:
-                msg_id = int(arg)
-                # If that worked, then we were probably just passed a message ID.
+            # Classify the argument up front, rather than letting int() raise for every non-numeric word.
+            target = None
+            if arg.isdecimal():
+                # We were probably just passed a message ID.
                 # If that's the case, then assume that means a message in the same channel as the command.
                 channel = message.channel
 
                 # And fetch the full message.
-                target = await self._refetch_message(channel.get_partial_message(msg_id))
-
-                return target, message.content[(end + 1):]
+                try:
+                    target = await self._refetch_message(channel.get_partial_message(int(arg)))
+                except HTTPException:
+                    pass
 
-            except (ValueError, HTTPException):
-                # If that didn't work, then we were probably passed a link.
-                matches = DISCORD_MESSAGE_URL_PATTERN.match(arg)
+            elif (ids := _parse_message_url(arg)) is not None:
+                # We were probably passed a link.
+                channel_id, msg_id = ids
 
+                # Try to fetch the message with that channel and message ID.
                 try:
-                    channel_id = matches.group(1)
-                    msg_id = matches.group(2)
-
-                    # Try to fetch the message with that channel and message ID.
                     channel = await self.fetch_channel(channel_id)
                     target = await self._refetch_message(channel.get_partial_message(msg_id))
+                except HTTPException:
+                    pass
 
-                    return target, message.content[(end + 1):]
-
-                except (AttributeError, IndexError, HTTPException) as e:
+            if target is not None:
+                return target, message.content[(end + 1):]
 
-                    # Okay. No link. No ID. No reply. Just find the last proxied message within 5 messages.
-                    prev_messages = message.channel.history(limit=5)
-                    async for msg in prev_messages:
-                        if msg.author.id == self.user.id:
-                            return msg, message.content[(message.content.find(command_terminator) + 1):]
+            # Okay. No link. No ID. No reply. Just find the last proxied message within 5 messages.
+            prev_messages = await self._get_recent(message, 5)
+            for msg in prev_messages:
+                if msg.author.id == self.user.id:
+                    return msg, message.content[(message.content.find(command_terminator) + 1):]
 
 
     async def _handle_content(self, message: Message, content: str):
@@ -249,21 +500,28 @@ class SeanceClient(discord.Client):
         if content:
             content = content.strip()
 
-        # Check if it is a shortcut reaction command.
-        for check, handler in self.shortcut_handlers.items():
-            if check(content):
-                await handler(message, content)
-                break
-        # Default to proxying the message
-        else:
-            # Now actually proxy the message.
-            try:
-                await self.proxy(message, content)
-            except HTTPException as e:
-                print(f"Failed to proxy message: {e}\nNot deleting original message.", file=sys.stderr)
-                return
+        # Check if it is a shortcut reaction command. Those all start with + or - and are short, so most messages
+        # can skip the checks entirely.
+        if content and content[0] in "+-" and len(content) < MAX_SHORTCUT_LEN:
+            for check, handler in self.shortcut_handlers:
+                if check(content):
+                    await handler(message, content)
+                    await self._delete_original(message)
+                    return
+
+        # Default to proxying the message.
+        try:
+            await self.proxy(message, content)
+        except HTTPException as e:
+            print(f"Failed to proxy message: {e}\nNot deleting original message.", file=sys.stderr)
+            return
+
+        await self._delete_original(message)
+
+
+    @staticmethod
+    async def _delete_original(message: Message):
 
-        # Delete the original message.
         try:
             await message.delete()
         except HTTPException as e:
@@ -277,13 +535,13 @@ class SeanceClient(discord.Client):
             try:
                 await target.add_reaction(payload)
             except HTTPException as e:
-                print(f"Failed to handle reaction: {e}\nNot deleting original message.", file=sys.stderr)
+                print(f"Failed to handle reaction: {e}", file=sys.stderr)
         # Handle removing a reaction
         else:
             try:
                 await target.remove_reaction(payload, self.user)
             except HTTPException as e:
-                print(f"Failed to handle reaction: {e}\nNot deleting original message.", file=sys.stderr)
+                print(f"Failed to handle reaction: {e}", file=sys.stderr)
 
     @staticmethod
     def _parse_activity_spec(spec: str) -> Optional[Activity]:
@@ -293,37 +551,28 @@ class SeanceClient(discord.Client):
         an activity format.
         """
 
-        matches = re.match(DISCORD_STATUS_PATTERN, spec)
-        if matches:
-            activity_type = matches.group("type")
-            if activity_type:
-                # Discord.py's names for these don't include the second word for "listening to"
-                # or "competing in", and are only in lowercase.
-                activity_type = activity_type.split()[0].lower()
-            else:
-                # If not specified, default to "Playing".
-                activity_type = "playing"
-
-            name = matches.group("name")
-
-            new_activity = Activity(type=ActivityType[activity_type], name=name)
+        parsed = _parse_activity_spec_cached(spec)
+        if parsed is None:
+            return None
 
-            return new_activity
-
-        return None
+        activity_type, name = parsed
+        return Activity(type=activity_type, name=name)
 
     @staticmethod
     async def proxy(message: Message, new_content: str):
         """ Sends a new message based on the metadata of the original, but with the modified content. """
 
-        # Copy over any attachments, and copy the inline reply if any.
-        files = [await att.to_file(spoiler=att.is_spoiler()) for att in message.attachments]
+        # Copy over any attachments (downloading them concurrently), and copy the inline reply if any.
+        if message.attachments:
+            files = await asyncio.gather(*(att.to_file(spoiler=att.is_spoiler()) for att in message.attachments))
+        else:
+            files = []
         ref = message.reference
         mention_flag = True
         if ref is not None:
             ref.fail_if_not_exists = False
-            if message.reference.resolved.author.id not in map(lambda x: x.id, message.mentions):
-                mention_flag = False
+            mention_ids = {mention.id for mention in message.mentions}
+            mention_flag = ref.resolved.author.id in mention_ids
 
         # Send the new message.
         await message.channel.send(new_content, files=files, reference=ref, mention_author=mention_flag)
@@ -339,9 +588,9 @@ class SeanceClient(discord.Client):
         # Otherwise, assume the most recent message within 5 messages.
         else:
 
-            prev_messages = message.channel.history(limit=5)
+            prev_messages = await self._get_recent(message, 5)
             target = None
-            async for msg in prev_messages:
+            for msg in prev_messages:
                 if msg.author.id == self.user.id:
                     target = msg
                     break
@@ -353,8 +602,9 @@ class SeanceClient(discord.Client):
         # Basic regular expressions suck.
         sed = Sed(regexp_extended = True)
 
-        # Don't include the command prefix.
-        start = message.content.find('!') + 1
+        # Don't include the command prefix. The layout of the command is known, so skip past it directly
+        # rather than searching the content for the '!'.
+        start = len(self._prefix_bang) if message.content.startswith(self._prefix_bang) else 1
         try:
             sed.load_string(message.content[start:])
             # Try to compile the script to see if it's well formed.
@@ -436,12 +686,7 @@ class SeanceClient(discord.Client):
         """ !presence [offline|dnd|idle|online|sync] -- changes the bot user's presence. """
 
         # Parse the command.
-        try:
-            _, *presence = message.content.split(' ')
-            presence = ' '.join(presence)
-        except ValueError:
-            print(f"Incorrect parameters for !presence: {message.content}", file=sys.stderr)
-            return
+        _command, _sep, presence = message.content.partition(' ')
 
         # If we're switching back to sync, sync!
         if presence == 'sync':
@@ -484,8 +729,8 @@ class SeanceClient(discord.Client):
                 print("Failed to sync to user's presence: could not find shared guild", file=sys.stderr)
                 return
 
-            ref_user_member = await mutual_guilds[0].fetch_member(self.ref_user_id)
-            applied_presence = ref_user_member.status if ref_user_member.status != Status.offline else Status.invisible
+            ref_user_member = await self._fetch_ref_member(mutual_guilds[0])
+            applied_presence = Status.invisible if ref_user_member.status is Status.offline else ref_user_member.status
 
             self._status_override = None
             self._cached_status = applied_presence
@@ -510,8 +755,7 @@ class SeanceClient(discord.Client):
         """ !status [status] -- sets the bot user's status. """
 
         # Get the arguments to the command.
-        _command, *args = message.content.split(' ')
-        args = ' '.join(args)
+        _command, _sep, args = message.content.partition(' ')
 
         # Parse out what activity this command is describing.
         new_activity = self._parse_activity_spec(args)
@@ -529,8 +773,7 @@ class SeanceClient(discord.Client):
         """ !nick [nickname] -- sets the bot user's nickname. """
 
         # Get the arguments to the command.
-        _command, *args = message.content.split(' ')
-        nickname = ' '.join(args)
+        _command, _sep, nickname = message.content.partition(' ')
 
         try:
             await message.guild.me.edit(nick=nickname)
@@ -549,6 +792,10 @@ class SeanceClient(discord.Client):
         """ Adds or removes a simple emoji reaction to a given message """
 
         target = await self._get_shortcut_target(message)
+        if target is None:
+            print("Failed to handle reaction: no message to react to.", file=sys.stderr)
+            return
+
         await self._handle_reaction(target, content[1], content[0] == '+')
 
 
@@ -556,24 +803,28 @@ class SeanceClient(discord.Client):
         """ Adds or removes a custom emoji reaction to a given message """
 
         target = await self._get_shortcut_target(message)
+        if target is None:
+            print("Failed to handle reaction: no message to react to.", file=sys.stderr)
+            return
 
-        group_dict = DISCORD_REACTION_SHORTCUT_PATTERN.fullmatch(content).groupdict()
+        action, emoji_id = _parse_custom_react(content)
 
         # Find the emoji in the client cache.
-        if emoji := self.get_emoji(int(group_dict["id"])):
+        if emoji := self.get_emoji(emoji_id):
             payload = emoji
         else:
-            # Fail over to searching the messaage reactions.
-            for react in target.reactions:
-                if react.emoji.id == int(group_dict["id"]):
-                    payload = react.emoji
-                    break
+            # Fail over to searching the messaage reactions. Unicode emoji reactions are plain strings, without IDs.
+            reactions_by_id = {
+                react.emoji.id: react.emoji for react in target.reactions if getattr(react.emoji, 'id', None) is not None
+            }
+            payload = reactions_by_id.get(emoji_id)
+
             # Fail out.
-            else:
+            if payload is None:
                 print(f"Custom Emoji ({content[1:]}) out of scope; not directly accessible by bot or present in message reactions.", file=sys.stderr)
                 return
 
-        await self._handle_reaction(target, payload, group_dict["action"] == '+')
+        await self._handle_reaction(target, payload, action == '+')
 
 
     async def handle_newdm_command(self, accountish):
@@ -591,6 +842,16 @@ class SeanceClient(discord.Client):
             silent=silent
         )
 
+
+    async def close(self):
+
+        # The DM manager batches its database writes, so make sure anything still pending gets written.
+        # (`run()` always goes through here on the way out.)
+        if self.dm_guild_manager is not None:
+            self.dm_guild_manager._flush_message_id_mappings()
+
+        await super().close()
+
     #
     # discord.py event handler overrides.
     #
@@ -607,6 +868,9 @@ class SeanceClient(discord.Client):
         print("Séance Discord client startup complete.")
 
         if self.sdnotify:
+            # Only imported when actually needed; main() has already checked that it's available.
+            import sdnotify
+
             # Tell systemd we've started up.
             notifer = sdnotify.SystemdNotifier(debug=True)
             notifer.notify("READY=1")
@@ -627,17 +891,37 @@ class SeanceClient(discord.Client):
             await self.dm_guild_manager.handle_typing(channel, user, when)
 
 
-    async def on_message(self, message: Message):
+    async def on_guild_channel_delete(self, channel):
 
-        # Sometimes message.content seems to be not-populated. Dunno why, but we can re-fetch to populate it.
-        if not message.content:
-            message = await self._refetch_message(message)
+        if self.dm_guild_manager is not None and channel.guild.id == self.dm_guild_id:
+            self.dm_guild_manager.forget_channel(channel)
+
+
+    async def on_guild_channel_update(self, before, _after):
+
+        # The channel may have been moved or had its topic (which the DM manager uses for the user ID) changed.
+        if self.dm_guild_manager is not None and before.guild.id == self.dm_guild_id:
+            self.dm_guild_manager.forget_channel(before)
+
+
+    async def on_webhooks_update(self, channel):
+
+        if self.dm_guild_manager is not None and channel.guild.id == self.dm_guild_id:
+            self.dm_guild_manager.forget_channel(channel)
+
+
+    async def on_message(self, message: Message):
 
+        # Note: messages are only re-fetched (see below) once we know we care about them,
+        # so that unrelated messages don't cost an API call.
 
         # If the message was a DM to this bot, and DM management is enabled, handle that.
         if self.dm_guild_manager is not None:
 
             if isinstance(message.channel, discord.DMChannel) and message.author.id != self.user.id:
+                if not message.content:
+                    message = await self._refetch_message(message)
+
                 await self.dm_guild_manager.handle_dm_to_server(message)
                 return
 
@@ -661,6 +945,10 @@ class SeanceClient(discord.Client):
         if message.author.id != self.ref_user_id:
             return
 
+        # Sometimes message.content seems to be not-populated. Dunno why, but we can re-fetch to populate it.
+        if not message.content:
+            message = await self._refetch_message(message)
+
 
         # If the message was sent in the designated DM guild, and DM management is enabled,
         # then proxy the message as a DM.
@@ -671,24 +959,28 @@ class SeanceClient(discord.Client):
                 return
 
 
+        content = message.content
+
         # See if the message matches the pattern that indicates we should proxy it.
-        if matches := self.pattern.match(message.content):
-            await self._handle_content(message, matches.groupdict()['content'])
+        if matches := self._match(content):
+            await self._handle_content(message, matches.group(self._content_group))
 
 
-        # Otherwise check for command prefixes.
-        else:
-            for string, handler in self.command_handlers.items():
-                if self._matches_command(message.content, string):
-                    await handler(message)
-                    break
+        # Otherwise check for commands.
+        elif content.startswith(self._command_tokens):
+
+            if content.startswith(self._substitute_commands):
+                await self.handle_substitute_command(message)
+
+            elif handler := self._command_table.get(content.partition(' ')[0]):
+                await handler(message)
 
 
     async def on_message_edit(self, before: Message, after: Message):
 
-        # Sometimes the content seems to be not-populated. Dunno why, but we can re-fetch to populate it.
-        if not after.content:
-            after = await self._refetch_message(after)
+        # These are checked several times below, so only look them up once.
+        author_id = after.author.id
+        own_id = self.user.id
 
         # # If the edited message was a DM to this bot, and DM management is enabled, handle that.
         # if self.dm_guild_manager is not None:
@@ -703,31 +995,42 @@ class SeanceClient(discord.Client):
 
 
             # Or, if the edit is not from this bot, and it's in a DM to this bot, proxy that through.
-            if after.author.id != self.user.id and after.channel.type == ChannelType.private:
-                self.dm_guild_manager.handle_dm_to_server_edit(after)
+            if author_id != own_id and after.channel.type == ChannelType.private:
+                await self.dm_guild_manager.handle_dm_to_server_edit(after)
                 return
 
 
             # Or, if the edit is from this bot, and we're in the DM server, proxy that through.
-            guild_id = after.guild.id if after.guild is not None else None
-            if after.author.id == self.user.id and guild_id == self.dm_guild_id:
-                self.dm_guild_manager.handle_server_to_dm_edit(after)
+            if author_id == own_id and (guild := after.guild) is not None and guild.id == self.dm_guild_id:
+                await self.dm_guild_manager.handle_server_to_dm_edit(after)
                 return
 
 
 
         # We only care about messages from the reference account.
-        if after.author.id != self.ref_user_id:
+        if author_id != self.ref_user_id:
             return
 
+        # Sometimes the content seems to be not-populated. Dunno why, but we can re-fetch to populate it.
+        # This is only done now that we know we care about this message, to save an API call for ones we don't.
+        if not after.content:
+            after = await self._refetch_message(after)
+
         # If the message wasn't actually edited, we con't care.
         if before.content == after.content:
             return
 
         # Normal proxy handling follows.
 
-        if matches := self.pattern.match(after.content):
-            await self._handle_content(after, matches.groupdict()['content'])
+        if matches := self._match(after.content):
+            await self._handle_content(after, matches.group(self._content_group))
+
+
+    async def on_member_update(self, before: Member, _after: Member):
+
+        # Any Member we have cached for the reference account is now out of date.
+        if before.id == self.ref_user_id:
+            self._last_ref_member_fetch = None
 
 
     async def on_presence_update(self, _before: Member, after: Member):
@@ -736,53 +1039,76 @@ class SeanceClient(discord.Client):
         if after.id != self.ref_user_id:
             return
 
-        status = after.status if after.status != Status.offline else Status.invisible
+        status = Status.invisible if after.status is Status.offline else after.status
 
-        # If we don't have a status override, adopt whatever status we've seen.
-        if self._status_override is None:
-            await self._set_presence(status=status)
+        # Presence updates also fire for activity changes and the like; if the status itself didn't change,
+        # there's nothing to do.
+        if status is self._cached_status:
+            return
+
+        # The status on any Member we have cached for the reference account is now out of date.
+        self._last_ref_member_fetch = None
 
         # Always cache the status, in case override turns off.
         self._cached_status = status
 
+        # If we don't have a status override, adopt whatever status we've seen.
+        # Rapid changes are coalesced, so only the most recent status gets sent to Discord.
+        if self._status_override is None and self._presence_sync_task is None:
+            self._presence_sync_task = asyncio.create_task(self._sync_presence_soon())
+
+
+# The options that don't depend on anything at runtime.
+_OPTIONS = (
+    ConfigOption(name='token', required=True,
+        help="The token to use for authentication. Required.",
+    ),
+    ConfigOption(name='ref user ID', required=True, metavar='ID', type=int,
+        help="The ID of the user to recognize messages to proxy from.",
+    ),
+    ConfigOption(name='pattern', required=True,
+        help="The Python regex used to match messages. Must have a named capture group called `content`.",
+    ),
+    ConfigOption(name='prefix', required=False, default='',
+        help="An additional prefix to accept commands with.",
+    ),
+    ConfigOption(name='default status', required=False, default=None,
+        help="The status to set upon startup",
+    ),
+    ConfigOption(name='default presence', required=False, default=None,
+        help="The presence to set upon startup",
+    ),
+    ConfigOption(name='DM server ID', required=False, default=None, metavar='ID', type=int,
+        help="The guild to use as the DM server. Not passing this disables DM mode.",
+    ),
+    ConfigOption(name='DM proxy untagged', required=False, default=None, type=bool,
+        help="When using DM mode, proxy untagged messages in the DM server.",
+    ),
+    ConfigOption(name='Forward pings', required=False, default=False, type=bool,
+        help="Whether to message the proxied user upon the bot getting pinged",
+    ),
+    ConfigOption(name='debug events', required=False, default=False, type=bool,
+        help="Have discord.py dispatch its raw socket debug events.",
+    ),
+)
+
 
 def main():
 
-    options = [
-        ConfigOption(name='token', required=True,
-            help="The token to use for authentication. Required.",
-        ),
-        ConfigOption(name='ref user ID', required=True, metavar='ID', type=int,
-            help="The ID of the user to recognize messages to proxy from.",
-        ),
-        ConfigOption(name='pattern', required=True,
-            help="The Python regex used to match messages. Must have a named capture group called `content`.",
-        ),
-        ConfigOption(name='prefix', required=False, default='',
-            help="An additional prefix to accept commands with.",
-        ),
-        ConfigOption(name='default status', required=False, default=None,
-            help="The status to set upon startup",
-        ),
-        ConfigOption(name='default presence', required=False, default=None,
-            help="The presence to set upon startup",
-        ),
-        ConfigOption(name='DM server ID', required=False, default=None, metavar='ID', type=int,
-            help="The guild to use as the DM server. Not passing this disables DM mode.",
-        ),
-        ConfigOption(name='DM proxy untagged', required=False, default=None, type=bool,
-            help="When using DM mode, proxy untagged messages in the DM server.",
+    # Just check if sdnotify is available without importing it, since it's only needed with --systemd-notify.
+    sdnotify_available = importlib.util.find_spec('sdnotify') is not None
+    help_addendum = ' (Requires `sdnotify` Python package, not found.)' if not sdnotify_available else ''
+    # Likewise for RE2 and --use-re2.
+    re2_available = importlib.util.find_spec('re2') is not None
+    re2_addendum = ' (Requires `google-re2` Python package, not found.)' if not re2_available else ''
+    options = _OPTIONS + (
+        ConfigOption(name='systemd notify', required=False, default=None, type=bool,
+            help=f'Notify systemd when startup is complete.{help_addendum}'
         ),
-        ConfigOption(name='Forward pings', required=False, default=False, type=bool,
-            help="Whether to message the proxied user upon the bot getting pinged",
+        ConfigOption(name='use RE2', required=False, default=False, type=bool,
+            help=f'Match the pattern with RE2, which runs in linear time, if it would match the same.{re2_addendum}'
         ),
-    ]
-
-    sdnotify_available = 'sdnotify' in sys.modules
-    help_addendum = ' (Requires `sdnotify` Python package, not found.)' if not sdnotify_available else ''
-    options.append(ConfigOption(name='systemd notify', required=False, default=None, type=bool,
-        help=f'Notify systemd when startup is complete.{help_addendum}'
-    ))
+    )
 
     help_epilog = ("All options can also be specified in an INI config (path passed with `--config`) "
         "as `key = value` under a section called `[Discord]`, where the key name is the option name "
@@ -799,13 +1125,43 @@ def main():
 
     try:
         pattern = re.compile(options.pattern, re.DOTALL)
-    except:
-        print('Invalid regular expression given for --pattern', file=sys.stderr)
-        raise
+    except re.error as e:
+        options.argparser.error(f'invalid regex for --pattern: {e}')
 
     if 'content' not in pattern.groupindex:
         options.argparser.error('regex pattern must have a named capture group called `content` (see https://docs.python.org/3/library/re.html#index-13')
 
+    # The pattern is run against every message the reference user sends, so RE2 can be used instead, since it
+    # guarantees matching in linear time. Patterns that RE2 would match differently, or doesn't support at all
+    # (like backreferences or lookarounds), stay with `re`.
+    if options.use_re2:
+        if not re2_available:
+            options.argparser.error('--use-re2 specified but `google-re2` Python package not available. Try `pip3 install google-re2`?')
+
+        import re2
+
+        # Other packages (like pyre2) also provide an `re2` module, with a different API.
+        if not hasattr(re2, 'Options'):
+            print("Warning: the installed `re2` module is not google-re2. Using Python's `re` for the pattern.",
+                file=sys.stderr
+            )
+        elif not re2_equivalent(pattern):
+            print("Warning: RE2 would match the pattern differently (it uses \\w, \\s, \\d, \\b, or $). "
+                "Using Python's `re` for the pattern.",
+                file=sys.stderr
+            )
+        else:
+            re2_options = re2.Options()
+            re2_options.dot_nl = True
+            # Falling back to `re` is handled here, so don't let RE2 log about patterns it can't handle.
+            re2_options.log_errors = False
+            try:
+                pattern = re2.compile(options.pattern, re2_options)
+            except re2.error as e:
+                print(f"Warning: RE2 does not support the pattern ({e}). Using Python's `re` for the pattern.",
+                    file=sys.stderr
+                )
+
     if options.systemd_notify and not sdnotify_available:
         options.argparser.error('--systemd-notify specified but `sdnotify` Python package not available. Try `pip3 install sdnotify`?')
 
@@ -819,7 +1175,9 @@ def main():
         if not sys.stdout.write_through:
             print("Warning: you seem to be running in a systemd service, but line buffering is on.", file=sys.stderr)
             print("Warning: Séance's output will not properly redirect to systemd-journald. Set $PYTHONUNBUFFERED=1", file=sys.stderr)
-            sys.stderr.flush()
+
+    # discord.py's own logging setup is disabled below, so this handles its logs as well.
+    log_listener = _setup_logging()
 
     intents = discord.Intents.default()
     intents.members = True
@@ -832,10 +1190,22 @@ def main():
         default_status = options.default_status,
         default_presence = options.default_presence,
         forward_pings=options.forward_pings,
+        debug_events=options.debug_events,
         intents=intents,
     )
+    # uvloop is a faster drop-in replacement for asyncio's event loop, so use it if it's available.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     print("Starting Séance Discord bot.")
-    client.run(options.token)
+    try:
+        client.run(options.token, log_handler=None)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -3,8 +3,10 @@ that the bot receives and for the bot to send. """
 
 import re
 import sys
-import time
+import asyncio
 import sqlite3
+import functools
+from io import BytesIO
 from datetime import datetime, timedelta
 
 import discord
@@ -12,7 +14,7 @@ import discord.abc
 import discord.utils
 import discord.errors
 import discord.app_commands
-from discord import User, Message, TextChannel, DMChannel, ChannelType, Guild
+from discord import User, Message, TextChannel, DMChannel, ChannelType, Guild, Webhook
 from discord.abc import Messageable
 from discord.errors import HTTPException
 
@@ -20,6 +22,7 @@ from discord import Interaction
 from discord.app_commands import CommandTree
 
 from ..errors import SeanceError
+from ..patterns import prefiltered_matcher
 
 
 class SeanceDMManagerError(SeanceError):
@@ -46,27 +49,50 @@ async def create_exception_and_send_message(error_type: type, text: str, channel
 def get_nested(d: dict, *keys):
     """ Gets nested dict values, returning None if any in the chain don't exist or are None. """
 
-    if len(keys) == 1:
-        return d[keys[0]]
-
-    else:
-        nested = d.get(keys[0], None)
-        if nested is not None:
-            return get_nested(nested, *keys[1:])
-        else:
+    for key in keys:
+        d = d.get(key)
+        if d is None:
             return None
 
+    return d
+
+
+@functools.lru_cache(maxsize=1024)
+def _sid(s: str) -> int:
+    """ Converts a snowflake ID stored as a string (like a DM-proxy channel's topic) to an int, caching the result,
+    since the same few IDs get converted on every DM event. Bounded, as the strings can be arbitrary user input.
+    """
+    return int(s)
+
 
 # With or without a nickname.
 DISCORD_USER_MENTION_PATTERN = re.compile(r'<@!?(?P<id>\d+)>')
 
 
 def datetime_to_unixtime(dt: datetime) -> int:
-    return int(time.mktime(dt.timetuple()))
+    return int(dt.timestamp())
 
 
 sqlite3.register_adapter(datetime, datetime_to_unixtime)
 
+# Message ID mappings are written to the database in batches, once this many are pending...
+MSG_ID_MAPPING_FLUSH_COUNT = 50
+# ...or once the oldest pending one has waited this long, in seconds.
+MSG_ID_MAPPING_FLUSH_SECONDS = 5
+
+# Mappings older than a day are swept out of the database once every this many inserts.
+MSG_ID_MAPPING_SWEEP_INTERVAL = 64
+
+# Bumped whenever the layout of the database changes.
+DB_SCHEMA_VERSION = 1
+
+# The queries run for every proxied message. These are kept as constants, so the text sqlite3 caches each
+# prepared statement by stays the same.
+SQL_INSERT_MAPPING = 'INSERT INTO "msg_id_mappings" ("dm_id", "server_id", "insertion_date") VALUES (?, ?, ?);'
+SQL_SWEEP_MAPPINGS = 'DELETE FROM "msg_id_mappings" WHERE "insertion_date" < ?;'
+SQL_SERVER_ID_FOR_DM_ID = 'SELECT "server_id" FROM "msg_id_mappings" WHERE "dm_id" = ?;'
+SQL_DM_ID_FOR_SERVER_ID = 'SELECT "dm_id" FROM "msg_id_mappings" WHERE "server_id" = ?;'
+
 class DiscordDMGuildManager:
 
     # XXX SWITCH PROXY UNTAGGED BACK TO FALSE
@@ -81,22 +107,39 @@ class DiscordDMGuildManager:
         self.guild = guild
         self.proxy_untagged = proxy_untagged
 
-        # If we weren't given an already compiled re.Pattern, compile it now.
-        if not isinstance(pattern, re.Pattern):
+        # If we weren't given an already compiled pattern (from `re` or `re2`), compile it now.
+        if isinstance(pattern, str):
             self.pattern = re.compile(pattern, re.DOTALL)
         else:
             self.pattern = pattern
 
-        self._db_con = sqlite3.connect('seance_dm.db')
-        cur = self._db_con.cursor()
-        cur.execute(
+        self._match_proxy = prefiltered_matcher(self.pattern)
+
+        # Transactions are managed explicitly (see `_flush_message_id_mappings()`), so sqlite3 shouldn't open its own.
+        self._db_con = sqlite3.connect('seance_dm.db', isolation_level=None)
+        # This database is only a cache, so trade a little durability on power loss for not waiting on two fsyncs
+        # every commit.
+        self._db_con.execute('PRAGMA journal_mode=WAL;')
+        self._db_con.execute('PRAGMA synchronous=NORMAL;')
+        self._db_con.execute('PRAGMA temp_store=MEMORY;')
+        self._db_con.execute('PRAGMA mmap_size=67108864;')
+        # Databases from before the schema was versioned declared the columns as BLOBs, and never actually made them
+        # NOT NULL. The table is only a cache, so just start it over.
+        if self._db_con.execute('PRAGMA user_version;').fetchone()[0] < DB_SCHEMA_VERSION:
+            self._db_con.execute('DROP TABLE IF EXISTS "msg_id_mappings";')
+            self._db_con.execute(f'PRAGMA user_version={DB_SCHEMA_VERSION};')
+        self._db_con.execute(
             'CREATE TABLE IF NOT EXISTS "msg_id_mappings" ('
                 '"entry_id" INTEGER PRIMARY KEY, '
-                '"dm_id" BLOB CONSTRAINT NOT_NULL, '
-                '"server_id" BLOB CONSTRAINT NOT_NULL, '
-                '"insertion_date" BLOB CONSTRAINT NOT_NULL'
+                '"dm_id" INTEGER NOT NULL, '
+                '"server_id" INTEGER NOT NULL, '
+                '"insertion_date" INTEGER NOT NULL'
             ');'
         )
+        # Lookups go by either ID, and the sweep in `_flush_message_id_mappings()` by date.
+        self._db_con.execute('CREATE INDEX IF NOT EXISTS "idx_dm_id" ON "msg_id_mappings" ("dm_id");')
+        self._db_con.execute('CREATE INDEX IF NOT EXISTS "idx_server_id" ON "msg_id_mappings" ("server_id");')
+        self._db_con.execute('CREATE INDEX IF NOT EXISTS "idx_insertion_date" ON "msg_id_mappings" ("insertion_date");')
         # cur.execute(
             # 'CREATE TABLE IF NOT EXISTS "server_to_dm" ('
                 # '"server_id" BLOB CONSTRAINT PRIMARY_KEY,'
@@ -104,12 +147,31 @@ class DiscordDMGuildManager:
                 # '"date" INTEGER CONSTRAINT NOT_NULL'
             # ');'
         # )
-        self._db_con.commit()
+
+        # Everything after setup goes through this one cursor, rather than allocating one per query.
+        self._cur = self._db_con.cursor()
+
+        # Mappings that haven't been written to the database yet, and the timer that will write them.
+        self._pending_mappings = []
+        self._flush_timer = None
+        self._inserts_since_sweep = 0
 
         self.admin_category = None
         self.friends_list_channel = None
         self.dm_category = None
 
+        # We're created once the client is ready, so its user is available already.
+        self._admin_category_name = '{} — Administrivia'.format(self.client.user.display_name)
+        self._dm_category_name = '{} — DMs'.format(self.client.user.display_name)
+
+        # DM-proxy channels and their webhooks, so every DM doesn't have to search for them (or, for webhooks,
+        # make an API request). Kept up to date by `forget_channel()`.
+        self._channel_by_user_id: dict[int, TextChannel] = {}
+        self._webhook_by_channel_id: dict[int, Webhook] = {}
+
+        # The insert count resets every launch, so also sweep now, in case we never reach the interval before exiting.
+        self._sweep_message_id_mappings()
+
         # CREATE TABLE IF NOT EXISTS "dm_to_server" (
         # "dm_id" BLOB CONSTRAINT PRIMARY_KEY,
         # "server_id" BLOB CONSTRAINT NOT_NULL,
@@ -120,78 +182,70 @@ class DiscordDMGuildManager:
 
 
     def _cache_message_id_mappings(self, *, dm_msg_id, server_msg_id):
+        """ Queues a mapping to be written by `_flush_message_id_mappings()`, rather than paying for a transaction
+        on every proxied message. """
 
-        cur = self._db_con.cursor()
+        self._pending_mappings.append((dm_msg_id, server_msg_id, datetime.now()))
 
-        now = datetime.now()
+        if len(self._pending_mappings) >= MSG_ID_MAPPING_FLUSH_COUNT:
+            self._flush_message_id_mappings()
+        elif self._flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self._flush_timer = loop.call_later(MSG_ID_MAPPING_FLUSH_SECONDS, self._flush_message_id_mappings)
 
-        cur.execute(
-            '''INSERT INTO "msg_id_mappings" ("dm_id", "server_id", "insertion_date") '''
-                '''VALUES (?, ?, ?);''',
-            (dm_msg_id, server_msg_id, now)
-        )
-
-        # cur.execute(
-            # 'INSERT INTO "server_to_dm" ("server_id", "dm_id", "date") VALUES (?, ?, ?);',
-            # (server_msg_id, dm_msg_id, now)
-        # )
 
-        self._db_con.commit()
+    def _flush_message_id_mappings(self):
+        """ Writes any pending message ID mappings to the database in a single transaction. """
 
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
 
-        # With that done, if have over 200 messages,
-        # then delete the least recently stored 100 of them.
-        cur = self._db_con.cursor()
+        if not self._pending_mappings:
+            return
 
-        dm_to_server_count = cur.execute(
-            'SELECT COUNT("dm_id") FROM "msg_id_mappings";'
-        ).fetchall()[0][0]
-        if dm_to_server_count > 200:
-            # Delete the cache for anything older than 24 hours ago.
-            yesterday = now - timedelta(days=1)
-            yesterday_unix = datetime_to_unixtime(yesterday)
-            cur.execute(
-                'DELETE FROM "msg_id_mappings" WHERE "entry_id" NOT IN ('
-                    'SELECT "entry_id" FROM "msg_id_mappings" WHERE "insertion_date" <= ? ORDER BY "insertion_date"'
-                ');',
-                (yesterday_unix,)
-            )
+        pending, self._pending_mappings = self._pending_mappings, []
 
+        # The connection as a context manager commits the transaction at the end, or rolls it all back on error.
+        with self._db_con:
+            cur = self._cur
+            cur.execute('BEGIN;')
 
-        self._db_con.commit()
+            cur.executemany(SQL_INSERT_MAPPING, pending)
 
+            # Every so often, delete the cache for anything older than 24 hours ago.
+            self._inserts_since_sweep += len(pending)
+            if self._inserts_since_sweep >= MSG_ID_MAPPING_SWEEP_INTERVAL:
+                self._sweep_message_id_mappings()
 
-    def _retrieve_message_id_mapping_for(self, *, dm_msg_id=None, server_msg_id=None):
 
-        if dm_msg_id is not None and server_msg_id is not None:
-            raise ValueError("Both dm_msg_id and server_msg_id specified")
+    def _sweep_message_id_mappings(self):
+        """ Deletes the cache for anything older than 24 hours ago. """
 
-        cur = self._db_con.cursor()
+        self._inserts_since_sweep = 0
+        yesterday_unix = datetime_to_unixtime(datetime.now() - timedelta(days=1))
+        self._cur.execute(SQL_SWEEP_MAPPINGS, (yesterday_unix,))
 
-        try:
 
-            if dm_msg_id is not None:
-
-                server_msg_id = cur.execute(
-                    'SELECT "server_id" FROM "msg_id_mappings" WHERE "dm_id" = ?',
-                    dm_msg_id,
-                ).fetchall()[0][0]
-
-                return server_msg_id
-
-            if server_msg_id is not None:
+    def _retrieve_message_id_mapping_for(self, *, dm_msg_id=None, server_msg_id=None):
 
-                dm_msg_id = cur.execute(
-                    'SELECT "dm_id" FROM "msg_id_mappings" WHERE "server_id" = ?',
-                    server_msg_id,
-                ).fetchall()[0][0]
+        if dm_msg_id is not None and server_msg_id is not None:
+            raise ValueError("Both dm_msg_id and server_msg_id specified")
 
-                return dm_msg_id
+        # The mapping we're looking for might not have been written yet.
+        self._flush_message_id_mappings()
 
+        cur = self._cur
 
-        except IndexError:
+        if dm_msg_id is not None:
+            row = cur.execute(SQL_SERVER_ID_FOR_DM_ID, (dm_msg_id,)).fetchone()
+        elif server_msg_id is not None:
+            row = cur.execute(SQL_DM_ID_FOR_SERVER_ID, (server_msg_id,)).fetchone()
+        else:
             return None
 
+        return row[0] if row is not None else None
+
 
     @discord.app_commands.describe(account='Snowflake ID or @mention of account to DM')
     async def handle_newdm_command(self, interaction: Interaction, account: str):
@@ -206,9 +260,7 @@ class DiscordDMGuildManager:
                 )
                 return
 
-            matches = DISCORD_USER_MENTION_PATTERN.match(account)
-            start, end = matches.span()
-            if end - start != len(account):
+            if DISCORD_USER_MENTION_PATTERN.fullmatch(account) is None:
                 await interaction.response.send_message("❌ `account` option must be a user ID or a mention and nothing else", ephemeral=True)
                 return
 
@@ -251,21 +303,26 @@ class DiscordDMGuildManager:
         # First, re-populate the guild so it has all of attributes we need.
         self.guild = self.client.get_guild(self.guild.id)
 
-        admin_category_name = '{} — Administrivia'.format(self.client.user.display_name)
-        admin_category = discord.utils.find(lambda cat : cat.name == admin_category_name, self.guild.categories)
+        # Index the categories by name once, rather than searching them for each one we need.
+        # Built in reverse so that, like a search would, the first of any with the same name wins.
+        categories_by_name = {cat.name: cat for cat in reversed(self.guild.categories)}
+
+        admin_category_name = self._admin_category_name
+        admin_category = categories_by_name.get(admin_category_name)
         if admin_category is None:
             admin_category = await self.guild.create_category(admin_category_name)
 
         self.admin_category = admin_category
 
-        friends_list_channel = discord.utils.find(lambda ch : ch.name == 'friends-list', admin_category.channels)
+        admin_channels_by_name = {ch.name: ch for ch in reversed(admin_category.channels)}
+        friends_list_channel = admin_channels_by_name.get('friends-list')
         if friends_list_channel is None:
             friends_list_channel = await admin_category.create_text_channel('friends-list')
 
         self.friends_list_channel = friends_list_channel
 
-        dm_category_name = '{} — DMs'.format(self.client.user.display_name)
-        dm_category = discord.utils.find(lambda cat : cat.name == dm_category_name, self.guild.categories)
+        dm_category_name = self._dm_category_name
+        dm_category = categories_by_name.get(dm_category_name)
         if dm_category is None:
             dm_category = await self.guild.create_category(dm_category_name)
 
@@ -281,14 +338,43 @@ class DiscordDMGuildManager:
     async def ensure_channel_for(self, user: User) -> TextChannel:
         """ Retrives the DM-proxy channel for the specified user, creating if necessary. """
 
+        if channel := self._channel_by_user_id.get(user.id):
+            return channel
+
         channel = discord.utils.find(lambda ch : ch.topic == str(user.id), self.dm_category.channels)
         if channel is None:
             name = '{}-{}'.format(user.name.lower(), user.discriminator.lower())
             channel = await self.dm_category.create_text_channel(name, topic=str(user.id))
 
+        self._channel_by_user_id[user.id] = channel
         return channel
 
 
+    async def _ensure_webhook_for(self, channel: TextChannel) -> Webhook:
+        """ Retrieves this bot's webhook for the specified DM-proxy channel, creating if necessary. """
+
+        if webhook := self._webhook_by_channel_id.get(channel.id):
+            return webhook
+
+        webhook = discord.utils.find(lambda hook : hook.user == self.client.user, await channel.webhooks())
+        if not webhook:
+            webhook = await channel.create_webhook(name=self.client.user.display_name)
+
+        self._webhook_by_channel_id[channel.id] = webhook
+        return webhook
+
+
+    def forget_channel(self, channel):
+        """ Drops anything cached about the specified channel. SeanceClient calls this when a channel in the DM
+        server is deleted or changed, or has its webhooks changed. """
+
+        self._webhook_by_channel_id.pop(channel.id, None)
+
+        for user_id, cached in list(self._channel_by_user_id.items()):
+            if cached.id == channel.id:
+                del self._channel_by_user_id[user_id]
+
+
     async def ensure_dm_for(self, channel: TextChannel) -> User:
         """ Retrieves the DM channel for the specified DM-proxy channel, creating if necessary.
 
@@ -300,7 +386,7 @@ class DiscordDMGuildManager:
         """
 
         try:
-            target_user_id = int(channel.topic)
+            target_user_id = _sid(channel.topic)
         except (ValueError, TypeError) as e:
             if channel.category.id == self.dm_category.id:
                 raise await create_exception_and_send_message(SeanceInvalidDMProxyChannelError,
@@ -345,13 +431,11 @@ class DiscordDMGuildManager:
         """ Proxies from the DM channel to the server channel via a webhook. """
 
         target_channel = await self.ensure_channel_for(message.author)
-
-        webhook = discord.utils.find(lambda hook : hook.user == self.client.user, await target_channel.webhooks())
-        if not webhook:
-            webhook = await target_channel.create_webhook(name=self.client.user.display_name)
+        webhook = await self._ensure_webhook_for(target_channel)
 
         # TODO: Handle replies.
-        files = [await att.to_file(spoiler=att.is_spoiler()) for att in message.attachments]
+        attachments = message.attachments
+        files = await asyncio.gather(*(att.to_file(spoiler=att.is_spoiler()) for att in attachments))
         server_message = await webhook.send(message.content, wait=True,
             username=message.author.name, avatar_url=message.author.display_avatar.url, files=files,
         )
@@ -373,19 +457,22 @@ class DiscordDMGuildManager:
             return
 
 
+        content = message.content
+        matches = self._match_proxy(content)
+
         if self.proxy_untagged:
 
             # If it *does* match the pattern, then we have to remove the proxy tag.
             # Otherwise, proxy as is.
-            if matches := self.pattern.match(message.content):
-                content_to_proxy = matches.groupdict()['content']
+            if matches:
+                content_to_proxy = matches.group('content')
             else:
-                content_to_proxy = message.content
+                content_to_proxy = content
 
         else:
 
-            if matches := self.pattern.match(message.content):
-                content_to_proxy = matches.groupdict()['content']
+            if matches:
+                content_to_proxy = matches.group('content')
             else:
                 # We're only supposed to match messages in the proxy format, but this message does not match.
                 # Nothing to do, so just return.
@@ -393,14 +480,25 @@ class DiscordDMGuildManager:
 
 
         # TODO: Handle replies.
-        files = [await att.to_file(spoiler=att.is_spoiler()) for att in message.attachments]
-        server_message = await message.channel.send(content_to_proxy, files=files)
+        # A File can only be sent once, and this message gets sent twice, so download each attachment once and make
+        # a separate File for each send.
+        attachments = message.attachments
+        attachment_data = await asyncio.gather(*(att.read() for att in attachments))
+
+        def make_files():
+            return [
+                discord.File(BytesIO(data), filename=att.filename, description=att.description,
+                    spoiler=att.is_spoiler())
+                for att, data in zip(attachments, attachment_data)
+            ]
+
+        server_message = await message.channel.send(content_to_proxy, files=make_files())
         try:
             await message.delete()
         except HTTPException as e:
             print(f"Failed to delete original message: {e}.", file=sys.stderr)
 
-        dm_message = await target_dm.send(content_to_proxy, files=files)
+        dm_message = await target_dm.send(content_to_proxy, files=make_files())
 
         self._cache_message_id_mappings(server_msg_id=server_message.id, dm_msg_id=dm_message.id)
 
@@ -0,0 +1,167 @@
+""" Helpers for inspecting the user-supplied proxy pattern, so that messages which can't possibly match it can be
+ruled out with cheap string operations before running the pattern itself. """
+
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11.
+    import sre_parse
+
+
+def literal_prefix(pattern) -> str:
+    """ Returns the literal text that anything `pattern` matches must start with, which may be empty.
+
+    `pattern` can be a compiled pattern from either `re` or `re2`. It's inspected with `re`'s parser, so if the
+    pattern isn't one `re` understands, this returns an empty string rather than guessing.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, getattr(pattern, 'flags', 0))
+    except re.error:
+        return ''
+
+    # With case-insensitive matching, the "literal" characters can match more than themselves.
+    if parsed.state.flags & re.IGNORECASE:
+        return ''
+
+    prefix = []
+    for op, arg in parsed:
+
+        # `^` doesn't consume anything, so the literal text can continue past it.
+        if op == sre_parse.AT and arg in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            continue
+
+        if op != sre_parse.LITERAL:
+            break
+
+        prefix.append(chr(arg))
+
+    return ''.join(prefix)
+
+
+def literal_suffixes(pattern) -> tuple[str, ...]:
+    """ Returns a tuple of strings, one of which anything `pattern` matches must end with (suitable for passing to
+    `str.endswith()`). This is `('',)` if there's no such requirement.
+
+    Since `match()` doesn't have to consume the whole string, this only applies to patterns that are anchored to the
+    end with `$` or `\\Z`. Like `literal_prefix()`, patterns that `re` doesn't understand get no assumptions made.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, getattr(pattern, 'flags', 0))
+    except re.error:
+        return ('',)
+
+    flags = parsed.state.flags
+    if flags & re.IGNORECASE or not len(parsed):
+        return ('',)
+
+    op, arg = parsed[-1]
+    if op != sre_parse.AT:
+        return ('',)
+
+    if arg == sre_parse.AT_END_STRING:
+        # `\Z` really is the end of the string.
+        allow_trailing_newline = False
+    elif arg == sre_parse.AT_END and not flags & re.MULTILINE:
+        # `$` also matches right before a newline at the end of the string.
+        allow_trailing_newline = True
+    else:
+        return ('',)
+
+    suffix = []
+    for op, arg in reversed(parsed[:-1]):
+        if op != sre_parse.LITERAL:
+            break
+
+        suffix.append(chr(arg))
+
+    suffix = ''.join(reversed(suffix))
+    if not suffix:
+        return ('',)
+
+    return (suffix, suffix + '\n') if allow_trailing_newline else (suffix,)
+
+
+def min_match_length(pattern) -> int:
+    """ Returns the length of the shortest string `pattern` could possibly match, which may be 0.
+
+    Like `literal_prefix()`, patterns that `re` doesn't understand are handled by making no assumptions (returning 0).
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, getattr(pattern, 'flags', 0))
+    except re.error:
+        return 0
+
+    min_width, _max_width = parsed.getwidth()
+    return min_width
+
+
+def _iter_items(parsed):
+    """ Yields every `(op, arg)` item in a parsed pattern, including those nested in groups, repeats, branches, and
+    character sets. """
+
+    for op, arg in parsed:
+        yield op, arg
+
+        if op == sre_parse.IN:
+            yield from arg
+        elif op == sre_parse.BRANCH:
+            for branch in arg[1]:
+                yield from _iter_items(branch)
+        elif isinstance(arg, tuple):
+            for sub in arg:
+                if isinstance(sub, sre_parse.SubPattern):
+                    yield from _iter_items(sub)
+
+
+def re2_equivalent(pattern) -> bool:
+    """ Returns whether RE2 would match the same things as `re` for `pattern`, a compiled `re` pattern.
+
+    RE2 supports most of `re`'s syntax, but some of it means something different: `\\w`, `\\s`, `\\d`, and `\\b` only
+    match ASCII in RE2 (unless the pattern is already `re.ASCII`), and `$` doesn't also match before a trailing
+    newline. Patterns using any of those are reported as not equivalent. Patterns RE2 can't compile at all aren't
+    checked for here.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except re.error:
+        return False
+
+    ascii_only = parsed.state.flags & re.ASCII
+
+    for op, arg in _iter_items(parsed):
+
+        if op == sre_parse.CATEGORY and not ascii_only:
+            return False
+
+        if op == sre_parse.AT:
+            if arg == sre_parse.AT_END:
+                return False
+            if arg in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY) and not ascii_only:
+                return False
+
+    return True
+
+
+def prefiltered_matcher(pattern):
+    """ Returns a function that works like `pattern.match(content)`, except that it returns None without running the
+    pattern at all when `content` is too short, or lacks the pattern's literal prefix or suffix, to possibly match.
+    """
+
+    prefix = literal_prefix(pattern)
+    suffixes = literal_suffixes(pattern)
+    min_len = min_match_length(pattern)
+    match = pattern.match
+
+    def match_if_possible(content: str):
+        if len(content) < min_len or not content.startswith(prefix) or not content.endswith(suffixes):
+            return None
+
+        return match(content)
+
+    return match_if_possible
@@ -10,6 +10,8 @@ import telegram
 from telegram import Update
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 
+from .patterns import prefiltered_matcher
+
 
 class SeanceClient:
 
@@ -17,10 +19,12 @@ class SeanceClient:
 
         self.ref_usernames = ref_usernames
         self.pattern = re.compile(pattern, re.DOTALL)
+        self._match = prefiltered_matcher(self.pattern)
 
         self.updater = Updater(token=token, use_context=True)
         message_filter = Filters.update.message & (~Filters.command) & Filters.user(username=self.ref_usernames)
-        message_handler = MessageHandler(message_filter, self.on_message)
+        # Proxying is a few blocking API requests, so let messages be handled concurrently rather than one at a time.
+        message_handler = MessageHandler(message_filter, self.on_message, run_async=True)
         self.updater.dispatcher.add_handler(message_handler)
 
 
@@ -35,8 +39,9 @@ class SeanceClient:
 
         # Rich text in Telegram is specified by an index, but we've changed the content, so those indicies are no
         # longer valid. So we have to shift those indecies by however much we changed the start of the content.
+        # The original message is about to be deleted, so its entities can just be adjusted in place.
 
-        entities = message.entities[:] if message.entities is not None else message.caption_entities[:]
+        entities = message.entities if message.entities is not None else message.caption_entities
         for entity in entities:
             entity.offset -= entity_shift
         
@@ -45,8 +50,8 @@ class SeanceClient:
         if message.video:
             context.bot.send_video(message.chat_id, message.video, caption=new_content, reply_to_message_id=reply_id, caption_entities=entities)
         elif message.photo:
-            # Assume that the largest number of pixels is the best version of the photo available?
-            largest_photo = max(message.photo, key=lambda photo : photo.width*photo.height)
+            # Telegram sends the available sizes of a photo smallest first, so the last one is the best version.
+            largest_photo = message.photo[-1]
             context.bot.send_photo(message.chat_id, largest_photo, caption=new_content, reply_to_message_id=reply_id, caption_entities=entities)
         else:
             context.bot.send_message(message.chat_id, new_content, reply_to_message_id=reply_id, entities=entities)
@@ -57,18 +62,18 @@ class SeanceClient:
         message: telegram.Message = update.message
 
         text = message.text if message.text is not None else message.caption
-        matches = self.pattern.match(text)
+        matches = self._match(text)
         if matches:
 
-            new_content = matches.groupdict()['content']
+            new_content = matches.group('content')
             offset_to_content = matches.start('content')
 
             if new_content:
-                pre_strip_len = len(new_content)
-                new_content = new_content.strip()
-                post_strip_len = len(new_content)
-                stripped_count = pre_strip_len - post_strip_len
-                offset_to_content += stripped_count
+                # Only whitespace stripped from the start moves the content, so the entities only need to shift by that.
+                unstripped = new_content
+                new_content = unstripped.lstrip()
+                offset_to_content += len(unstripped) - len(new_content)
+                new_content = new_content.rstrip()
 
             # Proxy the message.
             try: